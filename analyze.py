@@ -1,12 +1,43 @@
+import sys
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
 import matplotlib.pyplot as plt
 
-df = pd.read_csv("results_gemma3_64c.csv")
-print(df.describe(percentiles=[0.5, 0.95]))  # p50/p95 latency etc.
+# Usage: python analyze.py [run.py --csv file | one sweep.py --save-dir step dir]
+src = Path(sys.argv[1] if len(sys.argv) > 1 else "results_gemma3_64c.csv")
+
+# Both sources are reduced to the latencies of successful (200) requests.
+if src.is_dir():
+    # A sweep step dir, e.g. sweep_arrays/gemma3-27b_http-127.0.0.1-11434_64c_50n_128t_30p;
+    # mmap so only the pages touched are read.
+    lat_ns = np.load(src / "latency_ns.npy", mmap_mode="r")
+    status = np.load(src / "status.npy", mmap_mode="r")
+    lat = lat_ns[status == 200] / 1e9
+else:
+    # Only the needed columns are parsed; error text etc. never leaves Arrow.
+    # status is read as text: older CSVs hold "exception" for failed requests.
+    tbl = pv.read_csv(
+        str(src),
+        convert_options=pv.ConvertOptions(
+            include_columns=["latency", "status"],
+            column_types={"status": pa.string()},
+        ),
+    )
+    ok = tbl.column("status").to_numpy(zero_copy_only=False) == "200"
+    lat = tbl.column("latency").to_numpy()[ok]
+
+if lat.size == 0:
+    sys.exit(f"No successful requests in {src}")
+print(pd.Series(lat, name="latency").describe(percentiles=[0.5, 0.95]))  # p50/p95 latency
 
 # Histogram of latencies
+counts, edges = np.histogram(lat, bins=50)
 plt.figure()
-df["latency"].plot.hist(bins=50)
+plt.stairs(counts, edges, fill=True)
 plt.xlabel("Latency (s)")
-plt.title("Latency distribution – gemma3:27b, 64‑concurrency")
+plt.title(f"Latency distribution – {src.stem}")
 plt.show()
\ No newline at end of file
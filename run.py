@@ -16,64 +16,257 @@ python3 run.py \
     --tokens 256 \
     --csv results_gemma3_64c.csv
 
-Summary statistics (p50 / p95 latency, requests‑per‑second, error‑rate) are
+Summary statistics (p50 / p95 / p99 latency, requests‑per‑second, error‑rate) are
 printed to stdout.  If --csv is supplied, every request’s latency, token count
 and error status are written to that file for later analysis (e.g. Excel,
 Grafana, pandas).
 
 Dependencies
 ------------
-python -m pip install "httpx>=0.27,<1.0"
+python -m pip install "httpx>=0.27,<1.0" numpy orjson
+python -m pip install hdrhistogram    # optional: O(1)‑memory latency stats
+python -m pip install uvloop          # optional: faster event loop
+python -m pip install "httpx[http2]"  # optional: HTTP/2 to https:// hosts
 
 Tested with Python 3.10+.
 """
 import argparse
 import asyncio
+import contextlib
 import csv
-import statistics
+import re
+import sys
 import time
 from datetime import datetime
-from typing import List, Dict
+from typing import Dict, Iterator, Optional
 
 import httpx
+import numpy as np
+import orjson
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    from hdrh.histogram import HdrHistogram
+except ImportError:  # optional: pip install hdrhistogram
+    HdrHistogram = None
+
+try:
+    import h2  # noqa: F401  – presence enables httpx's HTTP/2 support
+except ImportError:  # optional: pip install "httpx[http2]"
+    h2 = None
+
+try:
+    import uvloop
+except ImportError:  # optional: pip install uvloop (not on Windows)
+    uvloop = None
+
+# Status recorded for requests that raised before any HTTP status arrived.
+STATUS_EXCEPTION = 0
+
+# Latencies above this are not tracked by the histogram (1 h, in µs).
+HIST_MAX_US = 3_600_000_000
+
+# Above this --tokens, metrics are read from the tail of the body instead of
+# decoding the (large) response text and context array.
+TAIL_PARSE_MIN_TOKENS = 512
+_TAIL_BYTES = 512
+_TAIL_METRIC = re.compile(rb'"(total_duration|eval_count)":(\d+)')
+
+# Sent with every POST.  Only gzip: the response body is read once and then
+# discarded, so the cheapest codec to decode is the one worth negotiating.
+_HEADERS = {"Content-Type": "application/json", "Accept-Encoding": "gzip"}
+
+# Per‑request CSV rows are written and flushed in batches of this many.
+CSV_BATCH = 1024
+
+# Columns of the per‑request CSV, in the order _summarizer writes them.
+FIELDNAMES = ("latency", "status", "total_duration", "tokens", "error")
 
 # ――― Internal helpers ――― ---------------------------------------------------
+def _json_metrics(body: bytes) -> tuple:
+    """Return ``(total_duration, eval_count)`` from a full JSON decode."""
+    data = orjson.loads(body)
+    return data.get("total_duration"), data.get("eval_count")
+
+
+def _tail_metrics(body: bytes) -> tuple:
+    """Return ``(total_duration, eval_count)`` by scanning the end of *body*.
+
+    Ollama serialises its timing/count fields after "response" and "context",
+    so for long generations only the last few hundred bytes need looking at.
+    Falls back to a full decode if either field isn't found there.
+    """
+    found = dict(_TAIL_METRIC.findall(body[-_TAIL_BYTES:]))
+    if b"total_duration" not in found or b"eval_count" not in found:
+        return _json_metrics(body)
+    return int(found[b"total_duration"]), int(found[b"eval_count"])
+
+
 async def _one_request(
     client: httpx.AsyncClient,
     url: str,
-    payload: dict,
-    sem: asyncio.Semaphore,
-    results: List[Dict],
+    body: bytes,
+    parse,
+) -> tuple:
+    """Send one /api/generate POST, reading its metrics with *parse*.
+
+    Returns ``(latency_ns, status, total_duration, tokens, error)``; fields that
+    don't apply to the outcome are ``None``.
+    """
+    started = time.perf_counter_ns()
+    try:
+        resp = await client.post(url, content=body, headers=_HEADERS, timeout=None)
+        latency_ns = time.perf_counter_ns() - started
+
+        if resp.status_code == 200:
+            dur_us, tokens = parse(resp.content)
+            # Ollama returns durations in µs; convert to seconds if present
+            dur = dur_us / 1e6 if dur_us is not None else None
+            return latency_ns, 200, dur, tokens, None
+        # Decode just the bytes we keep rather than the whole error body
+        error = resp.content[:200].decode(resp.encoding or "utf-8", "replace")
+        return latency_ns, resp.status_code, None, None, error
+    except Exception as exc:  # network/timeout etc.
+        latency_ns = time.perf_counter_ns() - started
+        return latency_ns, STATUS_EXCEPTION, None, None, repr(exc)[:200]
+
+
+async def _worker(
+    client: httpx.AsyncClient,
+    url: str,
+    body: bytes,
+    parse,
+    indices: Iterator[int],
+    queue: "asyncio.Queue[Optional[tuple]]",
+) -> None:
+    """Take request indices from the shared *indices* until it is exhausted.
+
+    Each outcome is handed to the summarizer as ``(idx, *_one_request(...))``.
+    """
+    for idx in indices:
+        outcome = await _one_request(client, url, body, parse)
+        await queue.put((idx, *outcome))
+
+
+async def _summarizer(
+    queue: "asyncio.Queue[Optional[tuple]]",
+    hist,
+    results: Optional[Dict[str, np.ndarray]],
+    errors: Optional[Dict[int, str]],
+    fp,
 ) -> None:
-    """Send one /api/generate POST and record latency & outcome."""
-    started = time.perf_counter()
-    async with sem:
+    """Fold request outcomes from *queue* into the stats until ``None`` arrives.
+
+    Successful latencies go into *hist* (if any); the full outcome of every
+    request is stored at its index in *results* / *errors* (if kept) and, if
+    *fp* is open, written as a CSV row.  Rows are flushed every CSV_BATCH, so
+    a killed run still leaves everything but the last batch on disk.
+    """
+    writer = csv.writer(fp) if fp is not None else None
+    if writer is not None:
+        writer.writerow(FIELDNAMES)
+    rows = []
+
+    while (item := await queue.get()) is not None:
+        idx, latency_ns, status, dur, tokens, error = item
+
+        if hist is not None and status == 200:
+            hist.record_value(latency_ns // 1000)
+        if results is not None:
+            results["latency_ns"][idx] = latency_ns
+            results["status"][idx] = status
+            if dur is not None:
+                results["total_duration"][idx] = dur
+            if tokens is not None:
+                results["tokens"][idx] = tokens
+            if error is not None:
+                errors[idx] = error
+        if writer is not None:
+            rows.append((latency_ns / 1e9, status, dur, tokens, error))
+            if len(rows) >= CSV_BATCH:
+                writer.writerows(rows)
+                fp.flush()
+                rows.clear()
+
+    if writer is not None:
+        writer.writerows(rows)
+
+
+def _make_client(max_connections: int) -> httpx.AsyncClient:
+    """Build an AsyncClient whose pool fits *max_connections* in‑flight POSTs.
+
+    HTTP/2 is enabled when h2 is installed, so requests to an https:// host
+    multiplex over a few connections.  Plain http:// stays on HTTP/1.1.
+    """
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+    )
+    return httpx.AsyncClient(timeout=None, limits=limits, http2=h2 is not None)
+
+
+def _raise_fd_limit(concurrency: int) -> Optional[int]:
+    """Make room in the open‑file limit for *concurrency* in‑flight requests.
+
+    Running out of fds shows up as connection errors and would inflate
+    error_rate, so the soft limit is raised to 4× *concurrency* (capped at the
+    hard limit), with a warning if it still ends up below 2×.  Returns the soft
+    limit now in effect, or None if it is unlimited or can't be queried.
+    """
+    if resource is None:
+        return None
+    wanted = concurrency * 4
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    if hard != resource.RLIM_INFINITY:
+        wanted = min(wanted, hard)
+    if soft < wanted:
         try:
-            resp = await client.post(url, json=payload, timeout=None)
-            latency = time.perf_counter() - started
-            entry = {"latency": latency, "status": resp.status_code}
-
-            if resp.status_code == 200:
-                data = resp.json()
-                # Ollama returns durations in µs; convert to seconds if present
-                dur_us = data.get("total_duration")
-                if dur_us is not None:
-                    entry["total_duration"] = dur_us / 1e6
-                entry["tokens"] = data.get("eval_count")
-            else:
-                entry["error"] = resp.text[:200]
-        except Exception as exc:  # network/timeout etc.
-            latency = time.perf_counter() - started
-            entry = {
-                "latency": latency,
-                "status": "exception",
-                "error": repr(exc)[:200],
-            }
-        results.append(entry)
-
-
-async def _run_batch(args) -> (dict, List[Dict]):
-    """Launch *args.requests* POSTs limited by *args.concurrency*."""
+            resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            soft = wanted
+        except (ValueError, OSError):
+            pass
+    if soft < concurrency * 2:
+        print(
+            f"warning: open‑file limit {soft} is low for {concurrency} "
+            "concurrent requests; errors may come from the client, not the server",
+            file=sys.stderr,
+        )
+    return soft
+
+
+def _asyncio_run(coro):
+    """Like asyncio.run, but on uvloop's faster event loop when installed."""
+    if uvloop is not None:
+        return uvloop.run(coro)
+    return asyncio.run(coro)
+
+
+async def _run_batch(
+    args, client: Optional[httpx.AsyncClient] = None, keep_samples: bool = False
+) -> (dict, Dict[str, np.ndarray], Dict[int, str]):
+    """Launch *args.requests* POSTs spread over *args.concurrency* workers.
+
+    Pass *client* to reuse its warm connection pool across batches (see
+    sweep.py); otherwise a client sized for *args.concurrency* is created.
+
+    Per‑request metrics come back column‑wise: *results* maps each metric to
+    an array indexed by request ordinal, and *errors* maps the ordinals of
+    failed requests to their error text.  When hdrh is installed only a
+    latency histogram is kept and both are None, unless *keep_samples*.
+    With *args.csv* set, every outcome is also streamed to that file while
+    the batch runs.  *args.fd_limit* (see _raise_fd_limit, called once by the
+    caller at startup) is only reported in the summary.
+    """
+    if client is None:
+        async with _make_client(args.concurrency) as client:
+            return await _run_batch(args, client, keep_samples)
+
     url = args.host.rstrip("/") + "/api/generate"
     payload = {
         "model": args.model,
@@ -81,28 +274,78 @@ async def _run_batch(args) -> (dict, List[Dict]):
         "stream": False,
         "options": {"num_predict": args.tokens},
     }
+    body = orjson.dumps(payload)  # identical for every request: encode once
+    parse = _tail_metrics if args.tokens > TAIL_PARSE_MIN_TOKENS else _json_metrics
 
-    sem = asyncio.Semaphore(args.concurrency)
-    results: List[Dict] = []
-    tasks = []
+    n = args.requests
+    # Shared by all workers and produced lazily: no per‑request objects
+    # exist until a worker is actually free to send that request.
+    indices = iter(range(n))
+    hist = HdrHistogram(1, HIST_MAX_US, 3) if HdrHistogram is not None else None
+    results: Optional[Dict[str, np.ndarray]] = None
+    errors: Optional[Dict[int, str]] = None
+    if hist is None or keep_samples:
+        results = {
+            "latency_ns": np.full(n, -1, dtype=np.int64),
+            "status": np.full(n, -1, dtype=np.int32),
+            "total_duration": np.full(n, np.nan),
+            "tokens": np.full(n, -1, dtype=np.int32),
+        }
+        errors = {}
 
-    async with httpx.AsyncClient(timeout=None) as client:
+    queue: asyncio.Queue[Optional[tuple]] = asyncio.Queue(maxsize=CSV_BATCH)
+
+    csv_file = (
+        open(args.csv, "w", newline="", buffering=1 << 20)
+        if args.csv
+        else contextlib.nullcontext()
+    )
+    with csv_file as fp:
+        summarizer = asyncio.create_task(_summarizer(queue, hist, results, errors, fp))
         batch_start = time.perf_counter()
-        for _ in range(args.requests):
-            tasks.append(
-                asyncio.create_task(_one_request(client, url, payload, sem, results))
-            )
-        await asyncio.gather(*tasks)
-    batch_elapsed = time.perf_counter() - batch_start
+        workers = [
+            asyncio.create_task(_worker(client, url, body, parse, indices, queue))
+            for _ in range(args.concurrency)
+        ]
+        running = set(workers)
+        try:
+            # The summarizer is the queue's only consumer: if it dies, workers
+            # block on put() forever, so wait on it alongside them.
+            while running:
+                done, running = await asyncio.wait(
+                    {summarizer, *running}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if summarizer in done:
+                    summarizer.result()  # before the sentinel it can only have raised
+                running.discard(summarizer)
+                for worker in done - {summarizer}:
+                    worker.result()  # re‑raise a worker failure
+            batch_elapsed = time.perf_counter() - batch_start
+        finally:
+            for worker in running:
+                worker.cancel()
+            if not summarizer.done():
+                await queue.put(None)
+            await summarizer
 
     # ――― Aggregate stats ―――
-    ok_latencies = [r["latency"] for r in results if r["status"] == 200]
-    p50 = statistics.median(ok_latencies) if ok_latencies else None
-    p95 = (
-        statistics.quantiles(ok_latencies, n=100)[94] if len(ok_latencies) >= 100 else None
-    )
-    error_rate = 1 - (len(ok_latencies) / len(results)) if results else 1.0
-    rps = len(results) / batch_elapsed if batch_elapsed > 0 else 0
+    if results is not None:
+        ok = results["latency_ns"][results["status"] == 200]
+        ok_count = ok.size
+        if ok_count:
+            p50, p95, p99 = (
+                float(v) / 1e9 for v in np.percentile(ok, [50, 95, 99])
+            )
+    else:
+        ok_count = hist.get_total_count()
+        if ok_count:
+            p50 = hist.get_value_at_percentile(50) / 1e6
+            p95 = hist.get_value_at_percentile(95) / 1e6
+            p99 = hist.get_value_at_percentile(99) / 1e6
+    if not ok_count:
+        p50 = p95 = p99 = None
+    error_rate = 1 - (ok_count / n) if n else 1.0
+    rps = n / batch_elapsed if batch_elapsed > 0 else 0
 
     summary = {
         "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
@@ -114,11 +357,13 @@ async def _run_batch(args) -> (dict, List[Dict]):
         "tokens": args.tokens,
         "p50_latency": p50,
         "p95_latency": p95,
+        "p99_latency": p99,
         "rps": rps,
         "error_rate": error_rate,
         "total_time": batch_elapsed,
+        "fd_limit": args.fd_limit,
     }
-    return summary, results
+    return summary, results, errors
 
 
 # ――― CLI entrypoint ――― ------------------------------------------------------
@@ -163,19 +408,15 @@ def main() -> None:
     )
 
     args = parser.parse_args()
+    args.fd_limit = _raise_fd_limit(args.concurrency)
 
-    summary, results = asyncio.run(_run_batch(args))
+    summary, _results, _errors = _asyncio_run(_run_batch(args))
 
     print("\n――― Summary ―――")
     for k, v in summary.items():
         print(f"{k:>15}: {v}")
 
     if args.csv:
-        fieldnames = sorted({key for r in results for key in r})
-        with open(args.csv, "w", newline="") as fp:
-            writer = csv.DictWriter(fp, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(results)
         print(f"\nDetailed metrics written to {args.csv}")
 
 
@@ -18,20 +18,36 @@ Optional flags (forwarded to run.py):
   --host         Ollama base URL
   --csv          master CSV (appends summaries)
 
+With --csv, the file doubles as a cache: a step whose (model, host,
+concurrency, requests, tokens, prompt length) already has a row there is not
+re-run, unless --force is given, the row is older than --max-age hours, or
+--save-dir is set and has no arrays for that step yet.
+Each step's row is appended as soon as it finishes, so an interrupted sweep
+resumes where it stopped.
+
+With --save-dir DIR, each step's per‑request arrays are written to
+DIR/<model>_<host>_<N>c_<requests>n_<tokens>t_<prompt length>p/<metric>.npy as
+soon as the step finishes (see analyze.py, which memory‑maps them back).
+
 Criteria for "trouble starts here" (tweakable):
 * p95 latency ≥ *threshold* seconds  (default 30 s)
 * error‑rate  ≥ 5 %
-First concurrency level that violates either threshold is reported.
+First concurrency level that violates either threshold is reported, and the
+sweep stops there (pass --no-early-stop to run the remaining levels anyway).
 """
 from __future__ import annotations
 
 import argparse
-import asyncio
+import csv
 import importlib
+import re
 import sys
+from datetime import datetime, timedelta
 from pathlib import Path
 from types import SimpleNamespace
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
 
 # Ensure run.py is importable
 sys.path.append(str(Path(__file__).absolute().parent))
@@ -40,39 +56,143 @@ run = importlib.import_module("run")  # our sibling file
 
 DEF_SWEEP = [1, 2, 4, 8, 16, 32, 64]
 
-
-async def _bench_once(ns) -> Dict:
-    summary, _results = await run._run_batch(ns)  # type: ignore[attr-defined]
+# Summary columns that need converting back from CSV text.
+_INT_FIELDS = ("concurrency", "requests", "prompt_len", "tokens", "fd_limit")
+_FLOAT_FIELDS = ("p50_latency", "p95_latency", "p99_latency", "rps", "error_rate", "total_time")
+
+# Per‑request arrays written for each step with --save-dir.
+_SAMPLE_NAMES = ("latency_ns", "status", "total_duration", "tokens")
+
+
+def _cache_key(summary: Dict) -> Tuple:
+    return (
+        summary["model"],
+        summary["host"],
+        summary["concurrency"],
+        summary["requests"],
+        summary["tokens"],
+        summary["prompt_len"],
+    )
+
+
+def _load_cache(path: str, max_age: Optional[float]) -> Dict[Tuple, Dict]:
+    """Read summary rows from *path*, newest row per key, skipping stale ones."""
+    if not Path(path).exists():
+        return {}
+    cutoff = datetime.utcnow() - timedelta(hours=max_age) if max_age is not None else None
+
+    cache: Dict[Tuple, Dict] = {}
+    with open(path, newline="") as fp:
+        for row in csv.DictReader(fp):
+            rec: Dict = dict(row)
+            for k in _INT_FIELDS:
+                rec[k] = int(rec[k]) if rec.get(k) else None
+            for k in _FLOAT_FIELDS:
+                rec[k] = float(rec[k]) if rec.get(k) else None
+            if cutoff is not None and datetime.fromisoformat(rec["timestamp"].rstrip("Z")) < cutoff:
+                continue
+            cache[_cache_key(rec)] = rec
+    return cache
+
+
+def _append_summary(path: str, summary: Dict) -> None:
+    """Append one summary row to *path*, keeping an existing file's header."""
+    fieldnames = list(summary)
+    new_file = not Path(path).exists() or Path(path).stat().st_size == 0
+    if not new_file:
+        with open(path, newline="") as fp:
+            fieldnames = next(csv.reader(fp))
+    with open(path, "a", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=fieldnames, extrasaction="ignore")
+        if new_file:
+            writer.writeheader()
+        writer.writerow(summary)
+
+
+def _slug(text: str) -> str:
+    return re.sub(r"[^\w.]+", "-", text).strip("-")
+
+
+def _step_dir(save_dir: str, key: Tuple) -> Path:
+    """Directory holding the arrays of the step with cache *key* under --save-dir.
+
+    Named after the whole key, so runs that differ only in host, requests,
+    tokens or prompt never share (or overwrite) each other's arrays.
+    """
+    model, host, concurrency, requests, tokens, prompt_len = key
+    return Path(save_dir) / (
+        f"{_slug(model)}_{_slug(host)}_{concurrency}c_{requests}n_{tokens}t_{prompt_len}p"
+    )
+
+
+def _has_samples(save_dir: str, key: Tuple) -> bool:
+    step_dir = _step_dir(save_dir, key)
+    return all((step_dir / f"{name}.npy").exists() for name in _SAMPLE_NAMES)
+
+
+def _save_samples(save_dir: str, summary: Dict, results: Dict) -> None:
+    """Write one step's per‑request arrays as .npy files (mmap‑able on load)."""
+    step_dir = _step_dir(save_dir, _cache_key(summary))
+    step_dir.mkdir(parents=True, exist_ok=True)
+    for name, arr in results.items():
+        np.save(step_dir / f"{name}.npy", arr)
+
+
+async def _bench_once(ns, client, save_dir: Optional[str] = None) -> Dict:
+    summary, results, _errors = await run._run_batch(  # type: ignore[attr-defined]
+        ns, client, keep_samples=save_dir is not None
+    )
+    if save_dir is not None:
+        _save_samples(save_dir, summary, results)
     return summary
 
 
 async def _sweep(args):
     trouble_at = None
     records: List[Dict] = []
-
-    for conc in args.concurrency_list:
-        ns = SimpleNamespace(
-            model=args.model,
-            host=args.host,
-            concurrency=conc,
-            requests=args.requests,
-            prompt=args.prompt,
-            tokens=args.tokens,
-            csv=None,  # no per‑request CSV
-        )
-        print(f"\n▶️  Running {conc}‑way concurrency …", flush=True)
-        summary = await _bench_once(ns)
-        records.append(summary)
-
-        ok = (
-            summary["p95_latency"] is not None
-            and summary["p95_latency"] < args.latency_threshold
-            and summary["error_rate"] < args.error_threshold
-        )
-        if not ok and trouble_at is None:
-            trouble_at = conc
-
-    return trouble_at, records
+    appended = 0
+    cache = _load_cache(args.csv, args.max_age) if args.csv and not args.force else {}
+
+    # One pool for the whole sweep: connections opened at step N are still
+    # warm at step N+1, so each step doesn't pay a fresh round of handshakes.
+    async with run._make_client(max(args.concurrency_list)) as client:  # type: ignore[attr-defined]
+        for conc in args.concurrency_list:
+            ns = SimpleNamespace(
+                model=args.model,
+                host=args.host,
+                concurrency=conc,
+                requests=args.requests,
+                prompt=args.prompt,
+                tokens=args.tokens,
+                csv=None,  # no per‑request CSV
+                fd_limit=args.fd_limit,
+            )
+            key = (args.model, args.host, conc, args.requests, args.tokens, len(args.prompt))
+            # A cached row is only enough if --save-dir already has its arrays
+            if key in cache and (
+                args.save_dir is None or _has_samples(args.save_dir, key)
+            ):
+                print(f"\n⏭️  Reusing {conc}‑way result from {args.csv}", flush=True)
+                summary = cache[key]
+            else:
+                print(f"\n▶️  Running {conc}‑way concurrency …", flush=True)
+                summary = await _bench_once(ns, client, args.save_dir)
+                if args.csv:
+                    _append_summary(args.csv, summary)
+                    appended += 1
+            records.append(summary)
+
+            ok = (
+                summary["p95_latency"] is not None
+                and summary["p95_latency"] < args.latency_threshold
+                and summary["error_rate"] < args.error_threshold
+            )
+            if not ok and trouble_at is None:
+                trouble_at = conc
+                if args.early_stop:
+                    break
+
+    return trouble_at, records, appended
 
 
 def main():
@@ -85,11 +205,30 @@ def main():
     p.add_argument("--host", default="http://127.0.0.1:11434")
     p.add_argument("--latency-threshold", type=float, default=30.0, help="p95 latency threshold in seconds (default: 30)")
     p.add_argument("--error-threshold", type=float, default=0.05, help="Error‑rate threshold (default: 0.05)")
-    p.add_argument("--csv", metavar="FILE", help="Append summary rows to this CSV")
+    p.add_argument(
+        "--early-stop",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Stop at the first concurrency level that crosses a threshold (default: on)",
+    )
+    p.add_argument("--csv", metavar="FILE", help="Append summary rows to this CSV (also reused as a cache)")
+    p.add_argument(
+        "--save-dir",
+        metavar="DIR",
+        help="Write each step's per-request arrays under this directory (for analyze.py)",
+    )
+    p.add_argument("--force", action="store_true", help="Re-run steps even if --csv already has them")
+    p.add_argument(
+        "--max-age",
+        type=float,
+        metavar="HOURS",
+        help="Only reuse --csv rows newer than this many hours (default: any age)",
+    )
 
     args = p.parse_args()
+    args.fd_limit = run._raise_fd_limit(max(args.concurrency_list))  # type: ignore[attr-defined]
 
-    trouble_at, records = asyncio.run(_sweep(args))
+    trouble_at, records, appended = run._asyncio_run(_sweep(args))  # type: ignore[attr-defined]
 
     print("\n――― Sweep Summary ―――")
     for rec in records:
@@ -103,18 +242,8 @@ def main():
     else:
         print("\n✅ No degradation detected within tested range.")
 
-    # Optional: append to CSV file
-    if args.csv:
-        import csv as _csv
-
-        fieldnames = records[0].keys()
-        new_file = not Path(args.csv).exists()
-        with open(args.csv, "a", newline="") as fp:
-            writer = _csv.DictWriter(fp, fieldnames=fieldnames)
-            if new_file:
-                writer.writeheader()
-            writer.writerows(records)
-        print(f"Summary rows appended to {args.csv}")
+    if appended:
+        print(f"{appended} summary row(s) appended to {args.csv}")
 
 
 if __name__ == "__main__":